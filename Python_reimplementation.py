@@ -2,60 +2,496 @@
 
 import openai
 import os
-from collections import defaultdict
+import sys
+import json
+import asyncio
+import hashlib
+import importlib.util
+from collections import OrderedDict, defaultdict, namedtuple
 import re
+import diskcache
+import httpx
+import numpy as np
 from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # Load environment variables
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# API endpoint; also part of the response cache key
+BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# One pooled connection set reused by every request, so the TLS handshake and TCP
+# slow-start are paid once rather than per call. HTTP/2 needs the h2 package
+# (httpx[http2]); without it the pool falls back to HTTP/1.1. The timeout is explicit
+# because a custom client does not inherit the SDK's defaults. Built on first use, so
+# importing this module needs neither an API key nor h2.
+http_client = None
+client = None
+
+def get_client():
+    global http_client, client
+    if client is None:
+        http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        # Retries are left to the tenacity policy on _complete; the SDK's own retries
+        # would multiply the attempts and back off while holding a semaphore slot
+        client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"), base_url=BASE_URL, http_client=http_client, max_retries=0
+        )
+    return client
+
+async def close_client():
+    global http_client, client
+    if http_client is not None:
+        await http_client.aclose()
+    http_client = None
+    client = None
+
+# Model is configurable; gpt-4o-mini is cheaper and faster than gpt-3.5-turbo
+MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+
+# Gateways such as Bedrock/OpenRouter (set OPENAI_BASE_URL) can serve a latency-optimized
+# variant; LLM_LATENCY_OPTIMIZED=1 asks for it through the non-standard body field
+EXTRA_BODY = {"performanceConfig": {"latency": "optimized"}} if os.getenv("LLM_LATENCY_OPTIMIZED") == "1" else {}
+
+# At most 10 requests in flight at once
+sem = asyncio.Semaphore(10)
+
+# Decode budget per KB; translations of these small KBs fit well inside it
+MAX_TOKENS = 512
+
+# Upper bound on any single request's max_tokens (gpt-4o-mini's output limit)
+MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "16384"))
+
+# Request body shared by live chat calls and Batch API input lines
+def _request_body(system_prompt, user_text, **options):
+    body = {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_text}
+        ],
+        "temperature": 0,
+        "max_tokens": MAX_TOKENS
+    }
+    body.update(options)
+    return body
+
+# Response cache: a bounded in-process LRU in front of an on-disk cache, keyed by a hash of
+# the endpoint and the full request. Requests use temperature=0, so a hit can stand in for
+# a call. LLM_CACHE=0 turns caching off; LLM_CACHE=refresh ignores cached entries and
+# overwrites them with fresh responses (to replace a bad entry).
+CACHE_MODE = os.getenv("LLM_CACHE", "1")
+CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./.llm_cache")
+MEMORY_CACHE_SIZE = 1024
+_memory_cache = OrderedDict()
+_disk_cache = None
+
+# The cache directory is only created once something is read or written
+def _get_disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        _disk_cache = diskcache.Cache(CACHE_DIR)
+    return _disk_cache
+
+def _cache_key(body):
+    request = {"base_url": BASE_URL, "body": body, "extra_body": EXTRA_BODY}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _remember(key, content):
+    _memory_cache[key] = content
+    _memory_cache.move_to_end(key)
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+def _cache_get(key):
+    if CACHE_MODE in ("0", "refresh"):
+        return None
+    content = _memory_cache.get(key)
+    if content is not None:
+        _memory_cache.move_to_end(key)
+        return content
+    content = _get_disk_cache().get(key)
+    if content is not None:
+        _remember(key, content)
+    return content
+
+def _cache_set(key, content):
+    if CACHE_MODE == "0":
+        return
+    _remember(key, content)
+    _get_disk_cache().set(key, content)
+
+# Worth retrying: rate limits, and timeouts or dropped connections, whether they happen
+# while opening the stream or part-way through reading it
+RETRYABLE_ERRORS = (
+    openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+    httpx.TimeoutException, httpx.TransportError
+)
+
+# Split streamed text into the lines it completes, as str.splitlines() would split the
+# whole reply. Returns (complete_lines, pending); a trailing '\r' stays pending in case
+# the next chunk starts with '\n'.
+def _complete_lines(text):
+    lines = text.splitlines(keepends=True)
+    if lines and (lines[-1].endswith('\r') or lines[-1].splitlines()[0] == lines[-1]):
+        return lines[:-1], lines[-1]
+    return lines, ""
+
+# Stream a completion with bounded concurrency. The whole attempt is retried with
+# exponential backoff, and each attempt collects into a fresh buffer. With
+# check_lines, each line is validated as soon as it arrives, with a fresh checker per
+# attempt; (content, errors) is returned, matching collect_errors(content).
+@retry(
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+)
+async def _complete(body, check_lines=False):
+    parts = []
+    finish_reason = None
+    errors = []
+    check_line, finish = logic_line_checker(errors)
+    pending = ""
+    async with sem:
+        stream = await get_client().chat.completions.create(**body, stream=True, extra_body=EXTRA_BODY or None)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            text = choice.delta.content
+            if text:
+                parts.append(text)
+                if check_lines:
+                    lines, pending = _complete_lines(pending + text)
+                    for line in lines:
+                        check_line(line)
+            finish_reason = choice.finish_reason or finish_reason
+    # A reply cut off at max_tokens is incomplete (and invalid JSON in JSON mode);
+    # fail here so it is never cached
+    if finish_reason == "length":
+        raise RuntimeError(f"Response truncated at max_tokens={body['max_tokens']}")
+    content = "".join(parts)
+    if not check_lines:
+        return content
+    check_line(pending)
+    finish()
+    if not content.strip():
+        errors.append(EMPTY_LOGIC_ERROR)
+    return content, errors
+
+# Shared chat call: served from the cache when the same request was made before.
+# With check_lines, returns (content, errors) as _complete does; a cached reply is
+# checked in one pass. parse, if given, turns the reply into the result and raises
+# RuntimeError on a malformed one; it runs before caching, so a bad reply is never stored.
+async def _chat(system_prompt, user_text, check_lines=False, parse=None, **options):
+    body = _request_body(system_prompt, user_text, **options)
+    key = _cache_key(body)
+    content = _cache_get(key)
+    if content is not None:
+        if check_lines:
+            return content, collect_errors(content)
+        if parse is None:
+            return content
+        try:
+            return parse(content)
+        except RuntimeError:
+            pass  # a malformed reply cached by an older version; fetch it again
+    result = await _complete(body, check_lines)
+    content = result[0] if check_lines else result
+    if parse is not None:
+        result = parse(content)
+    _cache_set(key, content)
+    return result
+
+# Parsing regexes, compiled once at import
+_SPLIT_PREDS_RE = re.compile(r',\s*(?![^()]*\))')
+_BATCH_ITEM_RE = re.compile(r'^###\s*Item\s+(\d+)\s*:?\s*$', re.MULTILINE)
+_ERROR_LINE_RE = re.compile(r'^Line (\d+): (.+)$')
 
 # Split body predicates properly (smart split — commas outside parentheses)
 def split_predicates(body_text):
-    return [x.strip() for x in re.split(r',\s*(?![^()]*\))', body_text)]
-
-# 1. LLM Translation
-def llm_translate(nl_text):
-    system_prompt = (
-        "Translate the following facts written in natural language into Prolog-style logic."
-        " Also, define rules if needed."
-        " Ensure that each predicate and rule is properly closed with parentheses and a period at the end."
-        " Do not use Markdown formatting or code blocks."
+    return [x.strip() for x in _SPLIT_PREDS_RE.split(body_text)]
+
+# Parse "name(a, b)" into ("name", ("a", "b")) by slicing around the outer parentheses;
+# None if the text is not an atom. Names and arguments are interned so the engine's
+# dict lookups and equality checks on them mostly short-circuit on identity.
+def _parse_atom(text):
+    lp = text.find('(')
+    rp = text.rfind(')')
+    if lp == -1 or rp < lp:
+        return None
+    return sys.intern(text[:lp].strip()), tuple(sys.intern(arg.strip()) for arg in text[lp + 1:rp].split(','))
+
+# 1. LLM Translation (translate, self-check and fix in a single request)
+TRANSLATE_INSTRUCTIONS = (
+    "Translate the following facts written in natural language into Prolog-style logic."
+    " Also, define rules if needed."
+    " Ensure that each predicate and rule is properly closed with parentheses and a period at the end."
+    " Before answering, check every line of your translation for a missing period or missing parentheses"
+    " and fix any errors you find."
+    " Do not use Markdown formatting or code blocks."
+)
+
+TRANSLATE_PROMPT = (
+    TRANSLATE_INSTRUCTIONS +
+    ' Respond with a JSON object of the form {"logic": "<the Prolog logic>", "self_checked": true}.'
+)
+
+# JSON mode for single translations (the batch prompt's '### Item k' reply is not one JSON object)
+TRANSLATE_OPTIONS = {"response_format": {"type": "json_object"}}
+
+BATCH_TRANSLATE_PROMPT = (
+    TRANSLATE_INSTRUCTIONS +
+    " You will receive several knowledge bases, each introduced by a line of the form '### Item k'."
+    " Answer every item separately and in the same order: write the same '### Item k' line, then on the"
+    ' next line a JSON object of the form {"logic": "<the Prolog logic>", "self_checked": true}'
+    " holding the translation of that item only."
+)
+
+# KBs per multi-KB translation request
+BATCH_PROMPT_SIZE = 8
+
+# Pull the logic out of the model's JSON answer (falls back to the raw text).
+# A list of lines is joined; any other non-string "logic" counts as a failed parse.
+def extract_logic(content):
+    try:
+        logic = json.loads(content)["logic"]
+    except (ValueError, KeyError, TypeError):
+        return content.strip()
+    if isinstance(logic, list) and all(isinstance(line, str) for line in logic):
+        return "\n".join(logic)
+    if not isinstance(logic, str):
+        return content.strip()
+    return logic
+
+async def llm_translate(nl_text):
+    return extract_logic(await _chat(TRANSLATE_PROMPT, nl_text, **TRANSLATE_OPTIONS))
+
+# Split a batch reply into its n answers; raises if any '### Item k' section is missing
+def _split_batch_reply(content, n):
+    # re.split with a capture group yields [preamble, k1, answer1, k2, answer2, ...]
+    parts = _BATCH_ITEM_RE.split(content)
+    answers = {int(k): extract_logic(answer) for k, answer in zip(parts[1::2], parts[2::2])}
+    missing = [k for k in range(1, n + 1) if k not in answers]
+    if missing:
+        raise RuntimeError(f"Batch reply has no '### Item k' section for item(s) {missing}")
+    return [answers[k] for k in range(1, n + 1)]
+
+# Translate several KBs with one request, delimited by '### Item k' markers
+async def llm_translate_batch(nl_texts):
+    user_prompt = "\n\n".join(f"### Item {k}\n{text.strip()}" for k, text in enumerate(nl_texts, start=1))
+    return await _chat(
+        BATCH_TRANSLATE_PROMPT, user_prompt,
+        parse=lambda content: _split_batch_reply(content, len(nl_texts)),
+        max_tokens=min(MAX_TOKENS * len(nl_texts), MAX_OUTPUT_TOKENS)
     )
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": nl_text}
-        ],
-        temperature=0
+
+# Offline translation through the Batch API: ~50% cheaper and outside the interactive
+# rate limits, but results can take up to 24h. Meant for large evaluation runs.
+# Like translate_kbs, returns {kb_number: logic} for the KBs that were translated.
+async def llm_translate_batch_offline(kbs, poll_interval=30):
+    results = {}
+
+    # Only KBs without a cached response are sent to the batch
+    bodies = {}
+    for k, kb in enumerate(kbs, start=1):
+        body = _request_body(TRANSLATE_PROMPT, kb, **TRANSLATE_OPTIONS)
+        content = _cache_get(_cache_key(body))
+        if content is not None:
+            results[k] = extract_logic(content)
+        else:
+            bodies[k] = body
+    if not bodies:
+        return results
+
+    batch_lines = [
+        json.dumps({
+            "custom_id": str(k),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {**body, **EXTRA_BODY}
+        })
+        for k, body in bodies.items()
+    ]
+    batch_input = await get_client().files.create(
+        file=("kb_batch.jsonl", "\n".join(batch_lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await get_client().batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
     )
-    return response['choices'][0]['message']['content']
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await get_client().batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}'")
+
+    # Output lines are not guaranteed to be in input order; custom_id is the KB number
+    if batch.output_file_id:
+        output = await get_client().files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"\nBatch request for KB {record['custom_id']} failed: {record.get('error')}")
+                continue
+            choice = response["body"]["choices"][0]
+            if choice.get("finish_reason") == "length":
+                print(f"\nBatch request for KB {record['custom_id']} was truncated at max_tokens")
+                continue
+            k = int(record["custom_id"])
+            content = choice["message"]["content"]
+            _cache_set(_cache_key(bodies[k]), content)
+            results[k] = extract_logic(content)
+
+    # Requests that failed outright are reported in a separate error file
+    if batch.error_file_id:
+        error_output = await get_client().files.content(batch.error_file_id)
+        for line in error_output.text.splitlines():
+            record = json.loads(line)
+            error = record.get("error") or (record.get("response") or {}).get("body")
+            print(f"\nBatch request for KB {record['custom_id']} failed: {error}")
+
+    # The missing KBs are left out; successful results are already cached, so a
+    # re-run only resubmits those
+    missing = sorted(set(bodies) - set(results))
+    if missing:
+        print(f"\nTranslation failed for KB(s) {', '.join(map(str, missing))}: no result in batch {batch.id}")
+    return {k: results[k] for k in sorted(results)}
 
 # 2. Check Logic Validity
-def check_logic_validity(logic_text):
-    errors = []
-    for line_num, line in enumerate(logic_text.strip().split('\n'), start=1):
+# Per-line checks, yielded lazily. `continues` marks a non-final line of a multi-line
+# rule (ending in ':-' or ','); parse_logic joins it with the next, so it needs no period.
+def _line_problems(stripped, continues=False):
+    if not continues and not stripped.endswith('.'):
+        yield "Missing period at end."
+    # Same test as _parse_atom: an opening '(' with a ')' somewhere after it
+    lp = stripped.find('(')
+    rp = stripped.rfind(')')
+    if lp == -1:
+        yield "Missing parentheses."
+    elif stripped.count('(') != stripped.count(')'):
+        yield "Unbalanced parentheses."
+    elif rp < lp:
+        yield "Missing parentheses."
+
+# An empty translation (e.g. a missing batch item or an empty "logic" field) is an error
+EMPTY_LOGIC_ERROR = "Line 1: Empty logic."
+
+def _line_errors(line_num, stripped, continues=False):
+    return [f"Line {line_num}: {problem}" for problem in _line_problems(stripped, continues)]
+
+# Incremental validator: returns (check_line, finish). check_line checks one line at a
+# time, appending to `errors`, so a response can be validated as its lines arrive;
+# finish() reports a rule still open at the end. Leading and trailing blank lines are
+# ignored (blank lines are only flagged once a later line follows). As in parse_logic, a
+# rule starts on a line containing ':-' and carries on while its lines end in ':-' or ','.
+def logic_line_checker(errors):
+    line_num = 0
+    pending_blank = 0
+    in_rule = False
+
+    def check_line(line):
+        nonlocal line_num, pending_blank, in_rule
         stripped = line.strip()
-        if not stripped.endswith('.'):
+        if not stripped:
+            if line_num:
+                pending_blank += 1
+            return
+        for _ in range(pending_blank):
+            line_num += 1
+            errors.extend(_line_errors(line_num, ""))
+        pending_blank = 0
+        line_num += 1
+        if stripped.startswith('%'):
+            errors.extend(_line_errors(line_num, stripped))
+            return
+        in_rule = in_rule or ':-' in stripped
+        continues = in_rule and stripped.endswith((':-', ','))
+        errors.extend(_line_errors(line_num, stripped, continues))
+        in_rule = continues
+
+    def finish():
+        if in_rule:
             errors.append(f"Line {line_num}: Missing period at end.")
-        if '(' not in stripped or ')' not in stripped:
-            errors.append(f"Line {line_num}: Missing parentheses.")
+
+    return check_line, finish
+
+# Fast path for the valid/invalid gate: stops at the first bad line
+def is_valid(logic_text):
+    if not logic_text.strip():
+        return False
+    errors = []
+    check_line, finish = logic_line_checker(errors)
+    for line in logic_text.splitlines():
+        check_line(line)
+        if errors:
+            return False
+    finish()
+    return not errors
+
+# Every error, for building the repair and refinement prompts
+def collect_errors(logic_text):
+    if not logic_text.strip():
+        return [EMPTY_LOGIC_ERROR]
+    errors = []
+    check_line, finish = logic_line_checker(errors)
+    for line in logic_text.splitlines():
+        check_line(line)
+    finish()
     return errors
 
+# Fix lines flagged by collect_errors where the repair is mechanical: drop blank and
+# comment lines, close unbalanced parentheses and add missing periods. Returns
+# (repaired_text, remaining_errors); only the remaining errors need llm_self_refine.
+def local_repair(logic_text, errors):
+    flagged = defaultdict(set)
+    for err in errors:
+        match = _ERROR_LINE_RE.match(err)
+        if match:
+            flagged[int(match.group(1))].add(match.group(2))
+
+    repaired = []
+    for line_num, line in enumerate(logic_text.strip().splitlines(), start=1):
+        problems = flagged.get(line_num)
+        if not problems:
+            repaired.append(line)
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith('%'):
+            continue
+        # Only unclosed '(' can be fixed mechanically; a stray ')' is left for the LLM
+        if "Unbalanced parentheses." in problems:
+            missing = stripped.count('(') - stripped.count(')')
+            if missing > 0:
+                if stripped.endswith('.'):
+                    stripped = stripped[:-1] + ')' * missing + '.'
+                else:
+                    stripped += ')' * missing
+        # A line ending in ':-' or ',' continues a rule; a period there would be wrong
+        if "Missing period at end." in problems and not stripped.endswith((':-', ',')):
+            stripped += '.'
+        repaired.append(stripped)
+
+    repaired_text = "\n".join(repaired)
+    return repaired_text, collect_errors(repaired_text)
+
 # 3. Self-Refinement
-def llm_self_refine(broken_logic, error_messages):
+async def llm_self_refine(broken_logic, error_messages):
     error_prompt = "\n".join(error_messages)
     system_prompt = f"The following logic has errors:\n{error_prompt}\nPlease fix the logic without using Markdown code blocks."
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": broken_logic}
-        ],
-        temperature=0
-    )
-    return response['choices'][0]['message']['content']
+    # The refined logic is validated line by line while it streams in
+    return await _chat(system_prompt, broken_logic, check_lines=True)
 
 # 4. Parse Facts and Rules
 def parse_logic(logic_text):
@@ -64,41 +500,73 @@ def parse_logic(logic_text):
 
     logic_text = logic_text.replace('```prolog', '').replace('```', '')
 
-    lines = logic_text.strip().split('\n')
-    current_rule = ""
+    lines = logic_text.strip().splitlines()
+    # Lines of a multi-line rule are buffered and joined once the rule is complete
+    current_rule_parts = []
     for line in lines:
         line = line.strip()
         if not line or line.startswith('%'):
             continue
-        if ':-' in line or current_rule:
-            current_rule += " " + line.strip()
-            if current_rule.strip().endswith('.'):
-                rules.append(current_rule.strip().strip('.'))
-                current_rule = ""
+        if ':-' in line or current_rule_parts:
+            current_rule_parts.append(line)
+            if line.endswith('.'):
+                rules.append(" ".join(current_rule_parts).strip('.'))
+                current_rule_parts.clear()
         else:
-            if '(' in line and ')' in line:
-                predicate, args = line.strip('.').split('(')
-                args = args.strip(')').split(',')
-                facts.append((predicate.strip(), [arg.strip() for arg in args]))
+            atom = _parse_atom(line)
+            if atom is not None:
+                facts.append(atom)
             else:
                 print(f"Skipping invalid line: {line}")
 
     return facts, rules
 
 # 5. Dynamic Reasoning Engine with Consistent Variable Binding
-from itertools import product
 
-def apply_rules(facts, rules):
-    fact_dict = defaultdict(list)
-    for predicate, args in facts:
-        fact_dict[predicate].append(args)
+# A rule compiled once into a join plan. Variables are numbered into slots of a bindings
+# list; slot n_vars always holds '?' for head variables the body never binds.
+# Each body atom records:
+#   bound     - argument positions already bound by earlier atoms (the index key)
+#   key_slots - the slots holding those positions' values
+#   binds     - (position, slot) pairs this atom binds first
+#   checks    - (position, slot) pairs repeating a variable bound earlier in the same atom
+# binary_join is set for rules that can use the vectorized join (see _binary_join_plan).
+CompiledRule = namedtuple('CompiledRule', 'head_pred head_args head_slots body n_vars binary_join')
+BodyAtom = namedtuple('BodyAtom', 'pred vars bound key_slots binds checks')
 
-    derived_facts = set()
+# Rules of the form h(...) :- p(A, B), q(C, D) whose two body atoms share exactly one
+# variable (e.g. grandparent) are joined on NumPy columns. Returns
+# (left_pos, right_pos, head_cols) with head_cols[k] = (atom, pos) or None for '?'.
+def _binary_join_plan(head_args, body_atoms):
+    if len(body_atoms) != 2:
+        return None
+    left, right = body_atoms
+    if any(len(atom.vars) != 2 or atom.vars[0] == atom.vars[1] for atom in body_atoms):
+        return None
+    shared = set(left.vars) & set(right.vars)
+    if len(shared) != 1:
+        return None
+    (join_var,) = shared
+
+    head_cols = []
+    for var in head_args:
+        if var in left.vars:
+            head_cols.append((0, left.vars.index(var)))
+        elif var in right.vars:
+            head_cols.append((1, right.vars.index(var)))
+        else:
+            head_cols.append(None)
+    return left.vars.index(join_var), right.vars.index(join_var), tuple(head_cols)
 
+def compile_rules(rules):
+    compiled = []
     for rule in rules:
-        head, body = rule.split(':-')
-        head_predicate, head_args = head.strip().split('(')
-        head_args = [h.strip() for h in head_args.strip(')').split(',')]
+        head, _, body = rule.partition(':-')
+        head_atom = _parse_atom(head)
+        if head_atom is None:
+            print(f"Skipping rule (invalid head): {rule}")
+            continue
+        head_predicate, head_args = head_atom
 
         body = body.strip()
         if body.startswith('(') and body.endswith(')'):
@@ -106,46 +574,175 @@ def apply_rules(facts, rules):
 
         body_predicates = split_predicates(body)
 
-        body_preds = []
+        body_atoms = []
+        slots = {}
         for b in body_predicates:
-            if '(' in b and ')' in b:
-                pred_name, pred_args = b.split('(')
-                pred_args = [arg.strip() for arg in pred_args.strip(')').split(',')]
-                body_preds.append((pred_name.strip(), pred_args))
+            atom = _parse_atom(b)
+            if atom is not None:
+                pred_name, pred_vars = atom
+                bound = tuple(p for p, var in enumerate(pred_vars) if var in slots)
+                key_slots = tuple(slots[pred_vars[p]] for p in bound)
+                binds = []
+                checks = []
+                for p, var in enumerate(pred_vars):
+                    if p in bound:
+                        continue
+                    if var in slots:
+                        checks.append((p, slots[var]))
+                    else:
+                        slots[var] = len(slots)
+                        binds.append((p, slots[var]))
+                body_atoms.append(BodyAtom(pred_name, pred_vars, bound, key_slots, tuple(binds), tuple(checks)))
             else:
                 print(f"Skipping invalid body predicate: {b}")
 
-        if len(body_preds) == 0:
+        if len(body_atoms) == 0:
             print(f"Skipping rule (no valid body predicates): {rule}")
             continue
 
-        # Cross-product of all possible matching facts
-        fact_sets = []
-        for pred_name, pred_vars in body_preds:
-            fact_sets.append(fact_dict.get(pred_name, []))
-
-        for fact_combo in product(*fact_sets):
-            var_bindings = {}
-            match = True
-            for (pred_vars, fact_args) in zip([bp[1] for bp in body_preds], fact_combo):
-                for var, val in zip(pred_vars, fact_args):
-                    if var in var_bindings:
-                        if var_bindings[var] != val:
-                            match = False
-                            break
-                    else:
-                        var_bindings[var] = val
-                if not match:
-                    break
-            if match:
-                result = tuple(var_bindings.get(var.strip(), '?') for var in head_args)
-                derived_facts.add((head_predicate, result))
+        body_atoms = tuple(body_atoms)
+        n_vars = len(slots)
+        head_slots = tuple(slots.get(var, n_vars) for var in head_args)
+        compiled.append(CompiledRule(head_predicate, head_args, head_slots, body_atoms, n_vars,
+                                     _binary_join_plan(head_args, body_atoms)))
+    return compiled
+
+# Facts of `pred` whose arguments at `positions` equal `key`, via a lazily built hash index
+def _lookup(fact_dict, index, pred, arity, positions, key):
+    buckets = index.get((pred, arity, positions))
+    if buckets is None:
+        buckets = defaultdict(list)
+        for args in fact_dict.get(pred, []):
+            if len(args) == arity:
+                buckets[tuple(args[p] for p in positions)].append(args)
+        index[(pred, arity, positions)] = buckets
+    return buckets.get(key, [])
+
+# Left-deep hash join: extend the bindings one body atom at a time,
+# only visiting facts that agree with the variables bound so far.
+# sources[i] is the (facts, index) pair that body atom i is matched against.
+# Slots are owned by the atom that binds them, so bindings is updated in place.
+def _join(body, i, bindings, sources):
+    if i == len(body):
+        yield bindings
+        return
+
+    atom = body[i]
+    key = tuple(bindings[slot] for slot in atom.key_slots)
+    fact_dict, index = sources[i]
+
+    for fact_args in _lookup(fact_dict, index, atom.pred, len(atom.vars), atom.bound, key):
+        for pos, slot in atom.binds:
+            bindings[slot] = fact_args[pos]
+        # Bound positions already match; still check variables repeated within this atom
+        if atom.checks and not all(bindings[slot] == fact_args[pos] for pos, slot in atom.checks):
+            continue
+        yield from _join(body, i + 1, bindings, sources)
+
+# Map values to int32 ids, interning new ones; names[id] maps back
+def _encode(values, ids, names):
+    encoded = np.empty(len(values), dtype=np.int32)
+    for k, value in enumerate(values):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(names)
+            names.append(value)
+        encoded[k] = value_id
+    return encoded
 
-    return derived_facts
+# Structure-of-arrays form of a binary relation: one int32 id column per argument
+def _columns(rows, ids, names):
+    rows = [args for args in rows if len(args) == 2]
+    return (_encode([args[0] for args in rows], ids, names),
+            _encode([args[1] for args in rows], ids, names))
+
+# Sort-merge join of two binary relations in column form on left[lpos] == right[rpos]
+def _binary_join(plan, left_cols, right_cols, names):
+    lpos, rpos, head_cols = plan
+    left_key = left_cols[lpos]
+    right_key = right_cols[rpos]
+
+    order = np.argsort(right_key, kind='stable')
+    sorted_key = right_key[order]
+    lo = np.searchsorted(sorted_key, left_key, side='left')
+    counts = np.searchsorted(sorted_key, left_key, side='right') - lo
+
+    # Expand each left row into its run of matching right rows
+    left_idx = np.repeat(np.arange(len(left_key)), counts)
+    starts = np.cumsum(counts) - counts
+    right_idx = order[np.arange(counts.sum()) + np.repeat(lo - starts, counts)]
+
+    columns = []
+    for col in head_cols:
+        if col is None:
+            columns.append(['?'] * len(left_idx))
+        else:
+            atom, pos = col
+            ids = left_cols[pos][left_idx] if atom == 0 else right_cols[pos][right_idx]
+            columns.append([names[i] for i in ids.tolist()])
+    return zip(*columns)
+
+# Evaluate rules already compiled by compile_rules() to a fixpoint, so derived facts
+# feed other rules. Semi-naive: every round, each rule is joined once per body atom
+# with that atom restricted to the facts that were new in the previous round.
+def apply_rules(facts, rules):
+    fact_dict = defaultdict(set)
+    for predicate, args in facts:
+        fact_dict[predicate].add(tuple(args))
+    delta = {pred: set(rows) for pred, rows in fact_dict.items()}
+
+    # Derived facts grouped by predicate: {pred: {args, ...}}
+    derived = defaultdict(set)
+    index = {}
+
+    # Column form of binary relations for the vectorized join, built on first use
+    ids = {}
+    names = []
+    columns = {}
+
+    while delta:
+        delta_index = {}
+        delta_columns = {}
+        new_facts = defaultdict(set)
+        for rule in rules:
+            for i, atom in enumerate(rule.body):
+                if atom.pred not in delta:
+                    continue
+                if rule.binary_join is not None:
+                    side_cols = []
+                    for j, body_atom in enumerate(rule.body):
+                        cache, rows = (delta_columns, delta) if j == i else (columns, fact_dict)
+                        if body_atom.pred not in cache:
+                            cache[body_atom.pred] = _columns(rows.get(body_atom.pred, ()), ids, names)
+                        side_cols.append(cache[body_atom.pred])
+                    results = _binary_join(rule.binary_join, side_cols[0], side_cols[1], names)
+                else:
+                    sources = [(fact_dict, index)] * len(rule.body)
+                    sources[i] = (delta, delta_index)
+                    bindings = [None] * rule.n_vars + ['?']
+                    results = (tuple(bindings[slot] for slot in rule.head_slots)
+                               for bindings in _join(rule.body, 0, bindings, sources))
+                for result in results:
+                    derived[rule.head_pred].add(result)
+                    if result not in fact_dict[rule.head_pred]:
+                        new_facts[rule.head_pred].add(result)
+
+        # Fold this round's facts into the full set and its existing indices and columns
+        for pred, rows in new_facts.items():
+            fact_dict[pred] |= rows
+            if pred in columns:
+                added = _columns(rows, ids, names)
+                columns[pred] = tuple(np.concatenate(pair) for pair in zip(columns[pred], added))
+        for (pred, arity, positions), buckets in index.items():
+            for args in new_facts.get(pred, ()):
+                if len(args) == arity:
+                    buckets[tuple(args[p] for p in positions)].append(args)
+        delta = new_facts
+
+    return derived
 
 # 6. Main Pipeline
-def main():
-    natural_language_kb = """
+EXAMPLE_KB = """
 John is the parent of Mary.
 Tom is the parent of Alice.
 Mary is the sibling of Tom.
@@ -153,28 +750,93 @@ Alice is the ancestor of Emma.
 Define uncle as someone who is a sibling of a parent.
 """
 
-    print("Translating natural language KB into logic...")
-    logic_output = llm_translate(natural_language_kb)
-    print("\nGenerated Logic:\n", logic_output)
-
-    errors = check_logic_validity(logic_output)
-    if errors:
+# Post-check one translation and fall back to LLM refinement if needed
+async def check_and_refine(logic_output):
+    if not is_valid(logic_output):
+        errors = collect_errors(logic_output)
         print("\nErrors found in logic:")
         for err in errors:
             print(err)
-        logic_output = llm_self_refine(logic_output, errors)
-        print("\nRefined Logic:\n", logic_output)
+        logic_output, errors = local_repair(logic_output, errors)
+        if not logic_output.strip():
+            # Refinement fixes logic; it cannot recover a translation that never arrived
+            print("\nNo logic to refine; skipping this KB.")
+        elif errors:
+            logic_output, errors = await llm_self_refine(logic_output, errors)
+            print("\nRefined Logic:\n", logic_output)
+            if errors:
+                print("\nRefined logic still has errors:")
+                for err in errors:
+                    print(err)
+        else:
+            print("\nRepaired Logic (fixed locally):\n", logic_output)
     else:
         print("\nLogic is valid. No refinement needed.")
+    return logic_output
+
+# Run one coroutine per KB ({kb_number: coroutine}) concurrently. A KB whose call fails
+# after its retries is reported and left out, instead of aborting every other KB.
+async def _gather_per_kb(stage, coros):
+    results = await asyncio.gather(*coros.values(), return_exceptions=True)
+    succeeded = {}
+    for k, result in zip(coros, results):
+        if isinstance(result, Exception):
+            print(f"\n{stage} failed for KB {k}: {result!r}")
+        else:
+            succeeded[k] = result
+    return succeeded
+
+# Translate KBs with as few round-trips as possible: a single KB gets its own JSON-mode
+# request; several KBs share one request per BATCH_PROMPT_SIZE, with the groups sent
+# concurrently. Returns {kb_number: logic} for the KBs that were translated.
+async def translate_kbs(kbs):
+    if len(kbs) == 1:
+        return await _gather_per_kb("Translation", {1: llm_translate(kbs[0])})
+
+    firsts = range(1, len(kbs) + 1, BATCH_PROMPT_SIZE)
+    groups = [kbs[first - 1:first - 1 + BATCH_PROMPT_SIZE] for first in firsts]
+    results = await asyncio.gather(*[llm_translate_batch(group) for group in groups], return_exceptions=True)
+
+    translated = {}
+    for first, group, result in zip(firsts, groups, results):
+        if isinstance(result, Exception):
+            print(f"\nTranslation failed for KBs {first}-{first + len(group) - 1}: {result!r}")
+            continue
+        for k, logic_output in enumerate(result, start=first):
+            translated[k] = logic_output
+    return translated
+
+# batch=True routes translation through the Batch API (for medium/large offline runs)
+async def main(kbs=None, batch=False):
+    if kbs is None:
+        kbs = [EXAMPLE_KB]
+
+    try:
+        print("Translating natural language KB into logic...")
+        if batch:
+            logic_outputs = await llm_translate_batch_offline(kbs)
+        else:
+            logic_outputs = await translate_kbs(kbs)
+        for logic_output in logic_outputs.values():
+            print("\nGenerated Logic:\n", logic_output)
+
+        # The model already self-checks; this is only a post-check before falling back to refinement
+        logic_outputs = await _gather_per_kb(
+            "Refinement", {k: check_and_refine(logic_output) for k, logic_output in logic_outputs.items()}
+        )
 
-    facts, rules = parse_logic(logic_output)
-    print("\nParsed Facts:", facts)
-    print("Parsed Rules:", rules)
+        for logic_output in logic_outputs.values():
+            facts, rules = parse_logic(logic_output)
+            print("\nParsed Facts:", facts)
+            print("Parsed Rules:", rules)
 
-    derived_facts = apply_rules(facts, rules)
-    print("\nDerived Facts:")
-    for pred, args in derived_facts:
-        print(f"{pred}({', '.join(args)})")
+            derived = apply_rules(facts, compile_rules(rules))
+            print("\nDerived Facts:")
+            for pred, args_set in derived.items():
+                for args in args_set:
+                    print(f"{pred}({', '.join(args)})")
+    finally:
+        await close_client()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())